@@ -1,6 +1,9 @@
 import graphviz
 import numpy as np
 
+# начиная с этого количества дочерних узлов вероятности считаются через numpy
+_NUMPY_MIN_CHILDREN = 8
+
 class Node:
     """
     Класс узла дерева PST
@@ -8,50 +11,58 @@ class Node:
     Атрибуты:
     parent - ссылка на объект родительского узла
     name - имя узла
+    key - ключ узла в словаре children родителя: id события в словаре
+            модели PST_model, если дерево строится моделью, иначе - имя узла
     level - уровень узла (0 - root)
-    children - словарь дочерних объектов 
-            {<объект>: [<количество объектов>, <вероятность перехода>]}
+    children - словарь дочерних объектов, индексированный по ключу
+            {<ключ>: {'node': <объект>, 'count': <количество объектов>, 'p': <вероятность перехода>}}
     has_children - флаг того, что у узла есть дочерние объекты
+    _children_by_name - те же записи children, индексированные по имени
+            (заполняется при вычислении вероятностей; по нему сопоставляются
+            узлы разных деревьев, ключи которых могут не совпадать)
 
     Методы:
     add_child - добавить дочерний узел
-    get_child_by_name - получить дочерний узел по имени
+    get_child_by_name - получить дочерний узел по ключу
     get_node_distance - вычислить расстояние до другого узла
     show_info - показать информацию об узле
     add_digraph_node - добавить узел для визуализации
     """
 
-    def __init__(self, parent, name):
+    __slots__ = (
+        'parent', 'name', 'key', 'level', 'children', 'has_children',
+        '_children_by_name',
+    )
+
+    def __init__(self, parent, name, key=None):
         self.parent = parent
         self.name = name
+        self.key = name if key is None else key
         self.level = parent.level+1 if parent else 0
         self.children = {}
         self.has_children = False
+        self._children_by_name = None
 
     def add_child(self, node):
         """
         Добавление дочернего узла и подсчет кол-ва дочерних узлов
         """
-        child = self.get_child_by_name(node.name)
+        entry = self.children.get(node.key)
         self.has_children = True
 
-        if child:
-            self.children[child]['count'] += 1
-            return child
+        if entry:
+            entry['count'] += 1
+            return entry['node']
 
         else:
-            self.children[node] = {'count': 1}
+            self.children[node.key] = {'node': node, 'count': 1}
             return node
 
-    def get_child_by_name(self, name):
+    def get_child_by_name(self, key):
         """
-        Возвращает дочерний элемент по имени, если не существует - None
+        Возвращает дочерний элемент по ключу (имени или id события), если не существует - None
         """
-        for child in self.children:
-            if child.name == name:
-                return child
-        
-        return None
+        return self.children.get(key, {}).get('node')
 
     def get_node_distance(self, node):    
         """
@@ -61,29 +72,52 @@ class Node:
         - если дочерний объект отсутствует - p1**2,
         где p1 и p2 - вероятности появления дочернего объекта в исходном
         и сравниваемом узла соответственно
+        (дочерние объекты сопоставляются по именам, а не по ключам)
         """
         if not self.has_children:
             return 0
 
-        distance = 0
-        
-        for child1, info1 in self.children.items():
-            if node == None:
-                distance += info1['p']**2
-                
-            elif child1.name in [c.name for c in node.children.keys()]:
-                info2 = node.children[node.get_child_by_name(child1.name)]
-                distance += (info1['p'] - info2['p'])**2
-                
+        if node is self:
+            return 0.0
+
+        if node == None or not node.has_children or self._children_by_name.keys().isdisjoint(node._children_by_name.keys()):
+            distance = 0.0
+
+            for info1 in self._children_by_name.values():
+                p1 = info1['p']
+                distance += p1*p1
+
+            return distance
+
+        distance = 0.0
+        other = node._children_by_name
+
+        if self._children_by_name.keys() == other.keys():
+            # все дочерние объекты есть в обоих узлах - проверка наличия не нужна
+            for name, info1 in self._children_by_name.items():
+                diff = info1['p'] - other[name]['p']
+                distance += diff*diff
+
+            return distance
+
+        get_other = other.get
+
+        for name, info1 in self._children_by_name.items():
+            p1 = info1['p']
+            info2 = get_other(name)
+
+            if info2 is not None:
+                diff = p1 - info2['p']
+                distance += diff*diff
+
             else:
-                distance += info1['p']**2
+                distance += p1*p1
 
         return distance
         
     
     def show_info(self):
-        childrens = {node.name:cnt for node,cnt in self.children.items()}
-        childrens = childrens if len(childrens) else 'No (LEAF)'
+        childrens = ', '.join(f"{info['node'].name}:{info['count']}" for info in self.children.values()) if self.has_children else 'No (LEAF)'
         parent = self.parent.name if self.parent else 'No (ROOT)'
 
         
@@ -92,8 +126,9 @@ class Node:
     def add_digraph_node(self, digraph):
         digraph.node(str(self), self.name)
         
-        if len(self.children) > 0:
-            for node, info in self.children.items():
+        if self.has_children:
+            for info in self.children.values():
+                node = info['node']
                 digraph.node(str(node), node.name)
                 digraph.edge(str(self), str(node), label=f"{info['p']:.2f}", penwidth=str(info['p']*4))
                 
@@ -109,80 +144,140 @@ class PST:
     depth - глубина дерева (по сути длина инициализирующей цепочки)
     power - количество элементов, на которых училось дерево
     has_children - флаг того, что у узла есть дочерние объекты
+    _prob_cache - кэш вероятностей последовательностей {<кортеж ключей>: <вероятность>}
+            (очищается при вычислении вероятностей переходов)
 
     Методы:
     add_subchain - добавить обучающую цепочку
+    get_subchain_prob - вычислить вероятность последовательности
     evaluate_probability - вычислить вероятности переходов
-    evaluate_node_probability - рекурсия для вычисления вероятностей
     show_tree_info - показать информацию о дереве
-    show_node_info - рекурсия для вывода информации о дереве
+    show_node_info - обход узлов для вывода информации о дереве
     plot_PST_graph - нарисовать граф дерева
     add_PST_node_to_digraph - добавление узла в граф дерева
     get_distance - вычислить расстояние между деревьями
-    get_node_distance - рекурсия для вычисления расстояния между деревьями
+    get_node_distance - обход узлов для вычисления расстояния между деревьями
     """
     
-    def __init__(self, init_chain):
-        self.root = Node(parent = None, name = init_chain[0])
+    def __init__(self, init_chain, names=None):
+        """
+        init_chain - инициализирующая цепочка ключей узлов,
+        names - имена событий цепочки (если не заданы, имена совпадают с ключами)
+        """
+        names = init_chain if names is None else names
+
+        self.root = Node(parent = None, name = names[0], key = init_chain[0])
         self.name = self.root.name
         self.depth = len(init_chain)
         self.power = 0 # мощность дерева (кол-во элементов, на которых училось)
+        self._prob_cache = {}
 
         node = self.root      
 
-        for element in init_chain[1:]:
-            new_node = Node(parent = node, name = element)
+        for element, name in zip(init_chain[1:], names[1:]):
+            new_node = Node(parent = node, name = name, key = element)
             node.add_child(new_node)
             node = new_node
 
-    def add_subchain(self, subchain):
+    def add_subchain(self, subchain, names=None):
         """
         добавление обучающей последовательности в дерево
+        (names - имена событий, если subchain содержит их id)
         """
+        names = subchain if names is None else names
         node = self.root
 
-        for element in subchain[1:]:
-            node = node.add_child(Node(parent = node, name = element))
+        for element, name in zip(subchain[1:], names[1:]):
+            node = node.add_child(Node(parent = node, name = name, key = element))
             
         self.power += 1
 
     def evaluate_probability(self):
         """
-        Вычисление вероятности перехода на основании счетчиков объектов
+        Вычисление вероятности перехода на основании счетчиков объектов:
+        за один обход узлов (стеком, без рекурсии) для каждого узла
+        заполняются вероятности и словарь _children_by_name
         """
-        self.evaluate_node_probability(self.root)
+        stack = [self.root]
 
-    def evaluate_node_probability(self, node):
+        while stack:
+            node = stack.pop()
+
+            if not node.has_children:
+                continue
+
+            entries = list(node.children.values())
+
+            if len(entries) < _NUMPY_MIN_CHILDREN:
+                cnt_sum = sum(i['count'] for i in entries)
+                for info in entries:
+                    info['p'] = info['count']/cnt_sum
+                    stack.append(info['node'])
+
+            else:
+                counts = np.fromiter((i['count'] for i in entries), dtype=np.float64, count=len(entries))
+                probs = counts / counts.sum()
+                for info, p in zip(entries, probs.tolist()):
+                    info['p'] = p
+                    stack.append(info['node'])
+
+            node._children_by_name = {i['node'].name: i for i in entries}
+
+        # вероятности переходов изменились, сохраненные результаты устарели
+        self._prob_cache.clear()
+
+    def get_subchain_prob(self, subchain):
         """
-        Рекурсия для прохода по всем узлам и вычисления их вероятности
+        вычисляет вероятность последовательности ключей (кортеж), начинающейся
+        с корня дерева, по текущим вероятностям переходов (результат кэшируется
+        до следующего вызова evaluate_probability)
         """
-        
-        if len(node.children) == 0:
-            return
+        try:
+            return self._prob_cache[subchain]
+
+        except KeyError:
+            pass
 
-        cnt_sum = sum(i['count'] for i in node.children.values())
-        for child in node.children:
-            node.children[child]['p'] = node.children[child]['count']/cnt_sum
-            self.evaluate_node_probability(child)        
+        node = self.root
+        prob = 1
+        for element in subchain[1:]:
+            entry = node.children.get(element)
+
+            if entry is None:
+                prob = 0
+                break
 
-    def show_tree_info(self):
+            prob *= entry['p']
+            node = entry['node']
+
+        self._prob_cache[subchain] = prob
+        return prob
+
+    def show_tree_info(self, verbose=True):
         """
-        Вывод информации о дереве
+        Вывод информации о дереве (при verbose=False ничего не выводится)
         """
+        if not verbose:
+            return
+
         self.show_node_info(self.root)
 
     def show_node_info(self, node):
         """
-        Рекурсия для прохода по всем узлам и вывода информации по ним
+        Обход всех узлов (стеком, без рекурсии) и вывод информации по ним
         """
-        
-        info = node.show_info()
-        
-        if len(node.children) == 0:
-            return
+        stack = [node]
+
+        while stack:
+            node = stack.pop()
+            node.show_info()
 
-        for child in node.children:
-            self.show_node_info(child)
+            if not node.has_children:
+                continue
+
+            # в обратном порядке, чтобы узлы выводились в порядке прямого обхода
+            for info in reversed(node.children.values()):
+                stack.append(info['node'])
 
     def plot_PST_graph(self):
         """
@@ -196,55 +291,66 @@ class PST:
 
     def add_PST_node_to_digraph(self, node, digraph):
         """
-        Рекурсия для прохода по всем узлам и добавления в граф для отрисовки
-        """        
-        digraph = node.add_digraph_node(digraph)
-        
-        if len(node.children) == 0:
-            return
+        Обход всех узлов (стеком, без рекурсии) и добавление их в граф для отрисовки
+        """
+        stack = [node]
+
+        while stack:
+            node = stack.pop()
+            digraph = node.add_digraph_node(digraph)
+
+            if not node.has_children:
+                continue
 
-        for child in node.children:
-            self.add_PST_node_to_digraph(child, digraph)
+            for info in reversed(node.children.values()):
+                stack.append(info['node'])
 
         return digraph
 
     def get_distance(self, pst):    
         """
         получение расстояния между деревьями на основании
-        вероятностей переходов между их узлами
+        вероятностей переходов между их узлами (узлы сопоставляются по именам,
+        поэтому можно сравнивать деревья разных моделей)
         """
 
         return self.get_node_distance(self.root, pst.root)
 
     def get_node_distance(self, node1, node2, distance=0, debug=False):
         """
-        Рекурсия для прохода по всем узлам и подсчета расстояний между ними
-        """        
-        if not node1.has_children:
-            return distance
+        Обход пар узлов (стеком, без рекурсии) и подсчет расстояний между ними
+        """
+        stack = [(node1, node2)]
 
-        
-        distance += node1.get_node_distance(node2)
+        while stack:
+            node1, node2 = stack.pop()
 
-        if debug:
-            
-            try:
-                print(f"{node1.name}-{node1.level}, {node2.name}-{node2.level}: {distance}")
-    
-            except:
-                print(f"{node1.name}-{node1.level}, ---: {distance}")   
-        
-        
-        for child1 in node1.children:
-            if node2 == None:
-                distance = self.get_node_distance(child1, None, distance)
-                
-            elif child1.name in [c.name for c in node2.children]:
-                child2 = node2.get_child_by_name(child1.name)
-                distance = self.get_node_distance(child1, child2, distance)
+            if not node1.has_children:
+                continue
+
+            distance += node1.get_node_distance(node2)
+
+            if debug:
                 
-            else:
-                distance = self.get_node_distance(child1, None, distance)
+                try:
+                    print(f"{node1.name}-{node1.level}, {node2.name}-{node2.level}: {distance}")
+        
+                except:
+                    print(f"{node1.name}-{node1.level}, ---: {distance}")   
+
+                # как и в рекурсивной версии, выводится только начальная пара узлов
+                debug = False
+
+            # в обратном порядке, чтобы сохранить порядок суммирования прямого обхода
+            for info1 in reversed(node1.children.values()):
+                child1 = info1['node']
+                child2_entry = node2._children_by_name.get(child1.name) if node2 != None and node2.has_children else None
+
+                if child2_entry is not None:
+                    stack.append((child1, child2_entry['node']))
+                    
+                else:
+                    stack.append((child1, None))
 
         return distance
         
@@ -256,18 +362,27 @@ class PST_model:
     Атрибуты:
     trees - список PST деревьев данного класса
     _depth - глубина дерева (по сути длина инициализирующей цепочки)
+    _trees_by_id - словарь деревьев модели по id корневого события
+    _vocab - словарь id событий {<имя события>: <id>}: дочерние узлы деревьев
+            модели индексируются по id (можно передать словарь, общий
+            для нескольких моделей)
 
 
     Методы:
     fit - обучение деревьев на выбранной последовательности
     get_PST_by_name - получение объекта класса PST по его имени из списка деревьев модели
     get_event_prob - вычисление вероятностей переходов по всем деревьям модели
+    _intern - получение id события (с регистрацией нового события)
+    _get_event_prob_by_ids - вычисление вероятности для последовательности id событий
+    get_chain_prob - вычисление вероятностей всех подпоследовательностей цепочки
     _get_subchains - получение последовательностей нужной длины для обучения деревьев
     """
     
-    def __init__(self, depth: int):
+    def __init__(self, depth: int, vocab=None):
         self._depth = depth
         self.trees = []
+        self._trees_by_id = {}
+        self._vocab = vocab if vocab is not None else {}
     
     def fit(self, chain):
         """
@@ -277,15 +392,19 @@ class PST_model:
         корневым элементом и события последовательности добавляются в соответствующее дерево
         Если ранее дерево не было создано, создается новое дерево
         """
-        
-        for subchain in self._get_subchains(chain):
+        ids = [self._intern(element) for element in chain]
+
+        for subchain, names in zip(self._get_subchains(ids), self._get_subchains(chain)):
 
-            if self.get_PST_by_name(subchain[0]):
-                self.get_PST_by_name(subchain[0]).add_subchain(subchain)
+            pst = self._trees_by_id.get(subchain[0])
+
+            if pst is None:
+                pst = PST(subchain, names)
+                self.trees.append(pst)
+                self._trees_by_id[subchain[0]] = pst
 
             else:
-                new_pst = PST(subchain)
-                self.trees.append(new_pst)   
+                pst.add_subchain(subchain, names)
 
         for tree in self.trees:
             tree.evaluate_probability()
@@ -294,11 +413,19 @@ class PST_model:
         """
         Возвращает дерево по имени из списка деревьев модели
         """
-        for tree in self.trees:
-            if tree.name == name:
-                return tree
-        
-        return None
+        return self._trees_by_id.get(self._vocab.get(name))
+
+    def _intern(self, name):
+        """
+        Возвращает id события, новое событие регистрируется в словаре модели
+        """
+        event_id = self._vocab.get(name)
+
+        if event_id is None:
+            event_id = len(self._vocab)
+            self._vocab[name] = event_id
+
+        return event_id
 
     def get_event_prob(self, subchain):
         """
@@ -310,41 +437,39 @@ class PST_model:
 
             return None
 
-        pst = self.get_PST_by_name(subchain[0])
-        if pst:
-            node = pst.root
-            prob = 1
-            for element in subchain[1:]:
-                child = node.get_child_by_name(element)
+        ids = tuple(self._vocab.get(element, -1) for element in subchain)
 
-                if child == None:
-                    return 0
-                else:
-                    prob *= node.children[child]['p']
-                    
-                node = child
+        return self._get_event_prob_by_ids(ids, subchain[0])
 
-            return prob
+    def _get_event_prob_by_ids(self, subchain, root_name):
+        """
+        вычисляет вероятность последовательности id событий (кортеж),
+        root_name - исходное имя первого события (для сообщения об отсутствии дерева)
+        """
+        pst = self._trees_by_id.get(subchain[0])
+        if pst:
+            return pst.get_subchain_prob(subchain)
                 
         else:
-            print(f"There are no PST with fisrt event id = {subchain[0]}")   
+            print(f"There are no PST with fisrt event id = {root_name}")   
             return 0
 
     def get_chain_prob(self, chain):
-        result = [np.NaN]*self._depth
+        """
+        вычисляет вероятности всех подпоследовательностей цепочки:
+        окна берутся из кортежа id событий (неизвестное событие - id -1)
+        """
+        result = [np.nan]*self._depth
+        ids = tuple(self._vocab.get(element, -1) for element in chain)
 
-        for subchain in self._get_subchains(chain):
-            result.append(self.get_event_prob(subchain))
+        for i, subchain in enumerate(self._get_subchains(ids)):
+            result.append(self._get_event_prob_by_ids(subchain, chain[i]))
 
         return result
 
     def _get_subchains(self, chain):
         """
-        получение подпоследовательностей установленной длины из заданной последовательности
+        генератор подпоследовательностей установленной длины из заданной последовательности
         """
-        subchains = []
-
         for i in range(len(chain) - self._depth):
-            subchains.append(chain[i:i+self._depth])
-
-        return subchains
\ No newline at end of file
+            yield chain[i:i+self._depth]
\ No newline at end of file